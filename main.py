@@ -1,5 +1,26 @@
 import csv
 import re
+from collections import namedtuple
+
+# Patterns and tokens used by extract_pack_size, compiled once at import time.
+_PACK_RE = re.compile(r'(\d+)\s*[- ]?pack', re.IGNORECASE)
+_DIGIT_RE = re.compile(r'(\d+)')
+_SINGLE_TOKENS = frozenset({'single disposable', 'single', 'one'})
+
+# Normalised attribute values that count as "no value" for canonical names.
+_EMPTY_ATTR_VALUES = frozenset({'', '0', '0.0'})
+
+# I/O buffer for the CSV files; fewer, larger reads and writes on multi-MB exports.
+_CSV_BUFFER_SIZE = 1 << 20
+
+# Number of output rows handed to csv.writer.writerows at a time.
+_WRITE_BATCH_SIZE = 10_000
+
+# One parsed row of the inventory export, held between the two loading passes.
+_InventoryRow = namedtuple(
+    '_InventoryRow',
+    'name vendor_sku cost price total_qty location_qty weight location upc row_index'
+)
 
 def extract_pack_size(product_name, unit_per_pack_str):
     """
@@ -7,58 +28,117 @@ def extract_pack_size(product_name, unit_per_pack_str):
     Uses a simple regex heuristic.
     """
     # Explicit check for common single indicators.
-    if unit_per_pack_str.strip().lower() in ['single disposable', 'single', 'one']:
+    if unit_per_pack_str.strip().lower() in _SINGLE_TOKENS:
         return 1
 
     # Try to extract using the product_name first.
-    match = re.search(r'(\d+)[- ]?[Pp]ack', product_name)
+    match = _PACK_RE.search(product_name)
     if match:
         return int(match.group(1))
     
     # Fallback: search the unit_per_pack_str.
     if unit_per_pack_str:
-        found = re.search(r'(\d+)', unit_per_pack_str)
+        found = _DIGIT_RE.search(unit_per_pack_str)
         if found:
             return int(found.group(1))
     
     # Default to 1 if nothing found.
     return 1
 
-def load_duoplane_mapping(duoplane_csv_file):
+def _to_int(value):
+    """
+    Convert a numeric CSV value such as "12" or "12.0" to an int, truncating
+    any decimal part. Plain decimal strings are parsed without going through
+    float(); anything else falls back to int(float(value)).
+    Returns 0 for empty or unparseable values.
+    """
+    if isinstance(value, int):
+        return value
+    value = value.strip()
+    if not value:
+        return 0
+    whole, _, fraction = value.partition('.')
+    if not fraction or fraction.isdigit():
+        try:
+            return int(whole or '0')
+        except ValueError:
+            pass
+    try:
+        return int(float(value))
+    except (ValueError, OverflowError):
+        return 0
+
+def _column_positions(header, names):
+    """
+    Look up the positions of the named columns in a CSV header.
+    Columns missing from the header get the position just past it, so rows
+    padded with one empty value there read "" for them, as DictReader's
+    row.get(name, '') did.
+    Returns the list of positions and the padding position, or None when
+    every column is present.
+    """
+    idx = {name: i for i, name in enumerate(header)}
+    pad_at = len(header)
+    positions = [idx.get(name, pad_at) for name in names]
+    return positions, (pad_at if pad_at in positions else None)
+
+def load_duoplane_mapping(duoplane_csv_file, vendor_skus=None):
     """
     Load the DuoPlane product list and create a mapping from vendor SKUs to retail SKUs.
     Only includes products from vendor "NV01".
     
     Args:
         duoplane_csv_file (str): Path to the DuoPlane CSV file
+        vendor_skus (set, optional): If given, only map these vendor SKUs
         
     Returns:
         dict: Mapping from vendor SKU to retail SKU
     """
     vendor_to_retail_sku_map = {}
     
-    with open(duoplane_csv_file, mode='r', encoding='utf-8', newline='') as infile:
-        reader = csv.DictReader(infile)
+    with open(duoplane_csv_file, mode='r', encoding='utf-8', newline='', buffering=_CSV_BUFFER_SIZE) as infile:
+        reader = csv.reader(infile)
+        (vendor_name_idx, vendor_sku_idx, retail_sku_idx), pad_at = _column_positions(
+            next(reader, []), ['vendor_name', 'vendor_sku', 'retailer_sku']
+        )
         for row in reader:
-            vendor_name = row.get('vendor_name', '').strip()
-            
+            if not row:
+                continue  # Skip blank lines, as DictReader did
+            if pad_at is not None:
+                row.insert(pad_at, '')
+            vendor_name = row[vendor_name_idx].strip()
+
             # Only process rows for vendor "NV01"
             if vendor_name == 'NV01':
-                vendor_sku = row.get('vendor_sku', '').strip()
-                retail_sku = row.get('retailer_sku', '').strip()
+                vendor_sku = row[vendor_sku_idx].strip()
+                retail_sku = row[retail_sku_idx].strip()
                 if(vendor_sku == "DRZLXS002503"):
                     print(f'Found DRZLXS002503 retail sku from load_duoplane_mapping: {retail_sku}')
-                if vendor_sku and retail_sku:
+                if vendor_sku and retail_sku and (vendor_skus is None or vendor_sku in vendor_skus):
                     vendor_to_retail_sku_map[vendor_sku] = retail_sku
     
     print(f"Loaded {len(vendor_to_retail_sku_map)} SKU mappings from vendor NV01")
     return vendor_to_retail_sku_map
 
 
-def generate_canonical_name(base_name, category, brand, volume, nicotine_level, flavor, resistance):
+def clean_canonical_attributes(volume, nicotine_level, flavor, resistance):
+    """
+    Normalize the attributes used in a canonical name.
+    Returns a tuple of the stripped, lower-cased values that are not empty or zero,
+    in the order volume, nicotine level, flavor, resistance.
+    """
+    attrs = []
+    for attr in (str(volume), str(nicotine_level), flavor, resistance):
+        attr_str = attr.strip().lower() if attr else ""
+        if attr_str not in _EMPTY_ATTR_VALUES:
+            attrs.append(attr_str)
+    return tuple(attrs)
+
+def generate_canonical_name(base_name, category, brand, attrs):
     """
     Build a canonical name using the provided base name and additional attributes.
     Include category and brand to better differentiate products.
+    attrs is the tuple returned by clean_canonical_attributes.
     """
     base_name = base_name.strip().lower()
     category = category.strip().lower() if category else ""
@@ -67,28 +147,9 @@ def generate_canonical_name(base_name, category, brand, volume, nicotine_level,
     # Start with category + brand + base name for more precise differentiation
     canonical = f"{category}_{brand}_{base_name}" if category and brand else base_name
     
-    attrs = []
-    for attr in [str(volume), str(nicotine_level), flavor, resistance]:
-        attr_str = attr.strip().lower() if attr else ""
-        if attr_str and attr_str not in ['0', '0.0']:
-            attrs.append(attr_str)
-    
     if attrs:
         canonical += " | " + " | ".join(attrs)
     return canonical
-
-def should_generate_canonical_name(volume, nicotine_level, flavor, resistance):
-    """
-    Determine if a product has enough data to generate a meaningful canonical name.
-    Returns True if at least one attribute has a value, False otherwise.
-    """
-    has_value = False
-    for attr in [str(volume), str(nicotine_level), flavor, resistance]:
-        attr_str = attr.strip().lower() if attr else ""
-        if attr_str and attr_str not in ['0', '0.0']:
-            has_value = True
-            break
-    return has_value
     
 
 def load_inventory_data(inventory_csv_file, duoplane_csv_file):
@@ -102,15 +163,12 @@ def load_inventory_data(inventory_csv_file, duoplane_csv_file):
         duoplane_csv_file (str): Path to the DuoPlane CSV file
         
     Returns:
-        tuple: (inventory_sku_map, duplicate_count, duplicate_skus)
+        tuple: (inventory_sku_map, duplicate_count, duplicate_skus), where duplicate_skus is a set
     """
-    # Load the DuoPlane mapping
-    vendor_to_retail_map = load_duoplane_mapping(duoplane_csv_file)
-    
     inventory_sku_map = {}
     duplicate_count = 0
-    duplicate_skus = []
-    unmapped_skus = []
+    duplicate_skus = set()
+    unmapped_skus = set()
     
     # First pass: collect all rows and track UPCs
     upc_to_sku_map = {}
@@ -119,51 +177,45 @@ def load_inventory_data(inventory_csv_file, duoplane_csv_file):
     # Temporary storage for all rows
     inventory_rows = []
 
-    with open(inventory_csv_file, mode='r', encoding='utf-8', newline='') as infile:
-        reader = csv.DictReader(infile)
-        for row_index, row in enumerate(reader):
-            vendor_sku = row.get('SKU', '').strip()
+    with open(inventory_csv_file, mode='r', encoding='utf-8', newline='', buffering=_CSV_BUFFER_SIZE) as infile:
+        reader = csv.reader(infile)
+        (
+            sku_idx, name_idx, cost_idx, price_idx, quantity_idx,
+            qty_1_idx, weight_idx, location_idx, upc_idx,
+        ), pad_at = _column_positions(
+            next(reader, []),
+            ['SKU', 'Name', 'Cost', 'Price', 'Quantity', 'Qty_1', 'Weight', 'Location_1', 'UPC'],
+        )
+        # Blank lines are skipped (and not counted in row_index), as DictReader did
+        for row_index, row in enumerate(row for row in reader if row):
+            if pad_at is not None:
+                row.insert(pad_at, '')
+            vendor_sku = row[sku_idx].strip()
             if not vendor_sku:
                 continue  # Skip if SKU is empty
 
-            # Map the vendor SKU to retail SKU
-            retail_sku = vendor_to_retail_map.get(vendor_sku)
-            if vendor_sku == "DRZLXS002503":
-                print(f'Found DRZLXS002503 retail sku: {retail_sku}')
-                print(f'Found DRZLXS002503 vendor sku: {vendor_sku}')
-            # If no mapping found, track it and use the vendor SKU directly
-            if not retail_sku:
-                unmapped_skus.append(vendor_sku)
-                retail_sku = vendor_sku
-            
             # Use default values for numeric fields to prevent skipping rows
             try:
-                cost = float(row.get('Cost', '0').strip() or '0')
+                cost = float(row[cost_idx].strip() or '0')
             except ValueError:
                 cost = 0.0
                 
             try:
-                price = float(row.get('Price', '0').strip() or '0')
+                price = float(row[price_idx].strip() or '0')
             except ValueError:
                 price = 0.0
                 
+            # Quantities are clamped to be non-negative once, here
+            total_qty = max(_to_int(row[quantity_idx]), 0)
+            location_qty = max(_to_int(row[qty_1_idx]), 0)
+
             try:
-                total_qty = int(float(row.get('Quantity', '0').strip() or '0'))
-            except ValueError:
-                total_qty = 0
-                
-            try:
-                location_qty = int(float(row.get('Qty_1', '0').strip() or '0'))
-            except ValueError:
-                location_qty = 0
-                
-            try:
-                weight = float(row.get('Weight', '0').strip() or '0')
+                weight = float(row[weight_idx].strip() or '0')
             except ValueError:
                 weight = 0.0
 
-            location = row.get('Location_1', '').strip()
-            upc = row.get('UPC', '').strip()
+            location = row[location_idx].strip()
+            upc = row[upc_idx].strip()
             
             # Track UPC usage
             if upc:
@@ -173,19 +225,18 @@ def load_inventory_data(inventory_csv_file, duoplane_csv_file):
                     upc_to_sku_map[upc] = vendor_sku
             
             # Store the row for processing after we've identified all duplicate UPCs
-            inventory_rows.append({
-                'name': row.get('Name', '').strip(),
-                'vendor_sku': vendor_sku,
-                'retail_sku': retail_sku,
-                'cost': cost,
-                'price': price,
-                'total_qty': total_qty,
-                'location_qty': location_qty,
-                'weight': weight,
-                'location': location,
-                'upc': upc,
-                'row_index': row_index
-            })
+            inventory_rows.append(_InventoryRow(
+                name=row[name_idx].strip(),
+                vendor_sku=vendor_sku,
+                cost=cost,
+                price=price,
+                total_qty=total_qty,
+                location_qty=location_qty,
+                weight=weight,
+                location=location,
+                upc=upc,
+                row_index=row_index
+            ))
 
     # # Report on duplicate UPCs
     # if duplicate_upcs:
@@ -193,11 +244,30 @@ def load_inventory_data(inventory_csv_file, duoplane_csv_file):
     #     for upc in duplicate_upcs:
     #         print(f"  - UPC {upc} is used by multiple products.")
     
-    # Second pass: process rows and handle duplicate UPCs
+    # Load the DuoPlane mapping, only for the vendor SKUs present in inventory
+    vendor_to_retail_map = load_duoplane_mapping(
+        duoplane_csv_file, {row.vendor_sku for row in inventory_rows}
+    )
+
+    # Running counts of the non-original rows seen so far for each duplicate UPC,
+    # overall and per vendor SKU, used to number the UPC suffixes in one pass
+    upc_conflict_counts = {}
+    upc_sku_conflict_counts = {}
+
+    # Second pass: map SKUs, process rows and handle duplicate UPCs
     for row in inventory_rows:
-        vendor_sku = row['vendor_sku']
-        retail_sku = row['retail_sku']
-        upc = row['upc']
+        vendor_sku = row.vendor_sku
+        upc = row.upc
+
+        # Map the vendor SKU to retail SKU
+        retail_sku = vendor_to_retail_map.get(vendor_sku)
+        if vendor_sku == "DRZLXS002503":
+            print(f'Found DRZLXS002503 retail sku: {retail_sku}')
+            print(f'Found DRZLXS002503 vendor sku: {vendor_sku}')
+        # If no mapping found, track it and use the vendor SKU directly
+        if not retail_sku:
+            unmapped_skus.add(vendor_sku)
+            retail_sku = vendor_sku
         
         # Handle duplicate UPCs - keep the original for the first product,
         # add a suffix digit for others
@@ -207,66 +277,64 @@ def load_inventory_data(inventory_csv_file, duoplane_csv_file):
                 # This is the first product with this UPC, keep it unchanged
                 pass
             else:
-                # Find all SKUs with this UPC to determine suffix number
-                conflict_count = 1
-                for other_row in inventory_rows:
-                    if other_row['upc'] == upc and other_row['vendor_sku'] == upc_to_sku_map.get(upc):
-                        # This is the original product with this UPC
-                        continue
-                    if other_row['upc'] == upc and other_row['vendor_sku'] != vendor_sku and other_row['row_index'] < row['row_index']:
-                        # This is another product with the same UPC that we've already processed
-                        conflict_count += 1
+                # The suffix number is one more than the earlier rows with this UPC,
+                # excluding the original product and rows for this same SKU
+                seen = upc_conflict_counts.get(upc, 0)
+                seen_same_sku = upc_sku_conflict_counts.get((upc, vendor_sku), 0)
+                conflict_count = 1 + seen - seen_same_sku
+                upc_conflict_counts[upc] = seen + 1
+                upc_sku_conflict_counts[(upc, vendor_sku)] = seen_same_sku + 1
                 
                 # Append the conflict count to make the UPC unique
                 original_upc = upc
                 upc = f"{upc}{conflict_count}"
                 # print(f"  - Changed UPC for {vendor_sku} from {original_upc} to {upc}")
         
-        # Additional product details
-        product_details = {
-            'name': row['name'],
-            'cost': row['cost'],
-            'price': row['price'],
-            'qty': max(row['total_qty'], 0),  # Ensure non-negative
-            'weight': row['weight'],
-            'upc': upc,  # Use potentially modified UPC
-            'retail_sku': retail_sku,
-            'locations': {},  # Dictionary to store location-specific quantities
-            'row_index': row['row_index']  # Track which row this came from
-        }
-
         if vendor_sku in inventory_sku_map:
             # This is a duplicate SKU
             duplicate_count += 1
-            duplicate_skus.append(vendor_sku)
+            duplicate_skus.add(vendor_sku)
 
             # Update existing SKU's locations
-            if row['location']:  # Only require location, not qty > 0
-                inventory_sku_map[vendor_sku]['locations'][row['location']] = max(row['location_qty'], 0)
+            if row.location:  # Only require location, not qty > 0
+                inventory_sku_map[vendor_sku]['locations'][row.location] = row.location_qty
                 
             # Keep track of the total quantity across all duplicates
-            inventory_sku_map[vendor_sku]['qty'] += max(row['total_qty'], 0)
+            inventory_sku_map[vendor_sku]['qty'] += row.total_qty
         else:
             # Create new SKU entry regardless of location/qty
-            if row['location']:
-                product_details['locations'][row['location']] = max(row['location_qty'], 0)
-            inventory_sku_map[vendor_sku] = product_details  # Always add the SKU
+            inventory_sku_map[vendor_sku] = {
+                'name': row.name,
+                'cost': row.cost,
+                'price': row.price,
+                'qty': row.total_qty,
+                'weight': row.weight,
+                'upc': upc,  # Use potentially modified UPC
+                'retail_sku': retail_sku,
+                # Dictionary to store location-specific quantities
+                'locations': {row.location: row.location_qty} if row.location else {},
+                'row_index': row.row_index  # Track which row this came from
+            }
+
+    # Encode each SKU's locations once for the output "locations" column
+    for data in inventory_sku_map.values():
+        data['locations_str'] = ';'.join(f"{loc}:{qty}" for loc, qty in data['locations'].items())
 
     print(f"Total unique SKUs after mapping: {len(inventory_sku_map)}")
     print(f"Total duplicate SKUs: {duplicate_count}")
-    print(f"Number of unique duplicate SKUs: {len(set(duplicate_skus))}")
+    print(f"Number of unique duplicate SKUs: {len(duplicate_skus)}")
     print(f"Number of unmapped vendor SKUs: {len(unmapped_skus)}")
     
     # # Print the first 20 unmapped SKUs (or all if less than 20)
     # if unmapped_skus:
     #     print("\nSample of unmapped vendor SKUs:")
-    #     for sku in sorted(set(unmapped_skus))[:20]:
+    #     for sku in sorted(unmapped_skus)[:20]:
     #         print(f"  - {sku}")
     
     # # Print the first 20 duplicate SKUs (or all if less than 20)
     # if duplicate_skus:
     #     print("\nSample of duplicate SKUs:")
-    #     for sku in sorted(set(duplicate_skus))[:20]:
+    #     for sku in sorted(duplicate_skus)[:20]:
     #         print(f"  - {sku}")
     
     return inventory_sku_map, duplicate_count, duplicate_skus
@@ -279,6 +347,12 @@ def clean_and_aggregate_magento_csv(input_file, output_file, inventory_csv_file,
     print(f"Total rows in inventory: {len(inventory_sku_map) + duplicate_count}")
     print(f"Total unique SKUs: {len(inventory_sku_map)}")
 
+    # Reverse index from retail SKU to vendor SKU; the first vendor SKU wins
+    retail_to_vendor_sku = {}
+    for vendor_sku, data in inventory_sku_map.items():
+        if data['retail_sku']:
+            retail_to_vendor_sku.setdefault(data['retail_sku'], vendor_sku)
+
     # Define the columns to keep from the CSV.
     columns_to_keep = [
         'sku',
@@ -308,15 +382,43 @@ def clean_and_aggregate_magento_csv(input_file, output_file, inventory_csv_file,
     # Extra columns we want to add.
     extra_columns = ['pack_size', 'canonical_name', 'single_product_sku', 'original_qty', 'upc', 'locations', 'retail_sku']
 
+    # Fields a simple product may inherit from its parent when missing.
+    fields_to_check = ['attribute_set_code', 'flavor', 'volume', 'nicotine_level', 'unit_per_pack', 'puff_counts', 'resistance']
+
     # First pass: read all rows and separate parent products from simple products.
     parent_products = {}
     simple_products = []
 
-    with open(input_file, mode='r', encoding='utf-8', newline='') as infile:
-        reader = csv.DictReader(infile)
-        for row in reader:
-            sku = row.get('sku', '').strip()
-            product_type = row.get('product_type', '').strip().lower()
+    with open(input_file, mode='r', encoding='utf-8', newline='', buffering=_CSV_BUFFER_SIZE) as infile:
+        reader = csv.reader(infile)
+        header = next(reader, [])
+        # Only carry the columns that can reach the output; Magento exports are wide.
+        wanted_columns = set(columns_to_keep + extra_columns)
+        keep_idx = [(name, i) for i, name in enumerate(header) if name in wanted_columns]
+        column_idx = dict(keep_idx)
+        (sku_idx, product_type_idx), pad_at = _column_positions(header, ['sku', 'product_type'])
+        fallback_idx = [(field, column_idx[field]) for field in fields_to_check if field in column_idx]
+        for values in reader:
+            if not values:
+                continue  # Skip blank lines, as DictReader did
+            if pad_at is not None:
+                values.insert(pad_at, '')
+            sku = values[sku_idx].strip()
+            product_type = values[product_type_idx].strip().lower()
+
+            # Parent products are only consulted for fallback values, so keep just
+            # their non-empty fallback fields and skip the inventory match. They are
+            # read straight from the CSV values without building a row dict.
+            if product_type != 'simple':
+                fallback_values = {}
+                for field, i in fallback_idx:
+                    value = values[i].strip()
+                    if value:
+                        fallback_values[field] = value
+                parent_products[sku] = fallback_values
+                continue
+
+            row = {name: values[i] for name, i in keep_idx}
 
             is_in_inventory = False
             vendor_sku_match = None
@@ -327,11 +429,8 @@ def clean_and_aggregate_magento_csv(input_file, output_file, inventory_csv_file,
                 is_in_inventory = True
             else:
                 # Try to find if this sku matches any retail_sku in our inventory
-                for vendor_sku, data in inventory_sku_map.items():
-                    if data['retail_sku'] and data['retail_sku'] == sku:
-                        vendor_sku_match = vendor_sku
-                        is_in_inventory = True
-                        break
+                vendor_sku_match = retail_to_vendor_sku.get(sku)
+                is_in_inventory = vendor_sku_match is not None
 
             # If this SKU is in the extra CSV, override cost and qty.
             if is_in_inventory and vendor_sku_match:
@@ -342,62 +441,53 @@ def clean_and_aggregate_magento_csv(input_file, output_file, inventory_csv_file,
                 row['weight'] = inventory_data['weight']
                 row['retail_sku'] = sku
                 row['sku'] = vendor_sku_match
-                row['locations'] = ';'.join(f"{loc}:{qty}" for loc, qty in inventory_data['locations'].items())
+                row['locations'] = inventory_data['locations_str']
             else:
                 row['qty'] = 0
                 row['locations'] = ''
                 row['vendor_sku'] = ''
 
-            # Only add simple products (that are in the extra CSV) to the output.
-            if product_type == 'simple':
-                simple_products.append(row)
-            else:
-                # For parent products, we want to load them regardless for fallback values.
-                if product_type != 'simple':
-                    parent_products[sku] = row
+            simple_products.append(row)
 
     # Track which inventory items have been processed
     processed_inventory_skus = set()
 
-    # Group products by their canonical key.
-    products_by_key = {}
+    # Group products by their canonical key. Each canonical name is interned
+    # to a dense integer id that indexes into product_groups. Each group keeps
+    # its rows alongside parallel pack_size / in-inventory columns, and tracks
+    # its single-pack SKU as rows arrive, preferring one in inventory.
+    canonical_ids = {}
+    product_groups = []
     standalone_products = []
-    
-    all_rows_to_write = []
+
     for row in simple_products:
-        parent_sku = row.get('parent_sku', '').strip()
+        # Bind the row accessors once; the fields below are read from locals.
+        get = row.get
+        sku = row['sku']
+        parent_sku = get('parent_sku', '').strip()
         parent = parent_products.get(parent_sku)
 
         # If fields are missing in the simple product, try to use the parent's values.
         # For numeric fields, we consider empty strings or "0"/"0.0" as missing.
         # For text fields (like flavor), an empty value is considered missing.
-        fields_to_check = ['attribute_set_code', 'flavor', 'volume', 'nicotine_level', 'unit_per_pack', 'puff_counts', 'resistance']
-
-        for field in fields_to_check:
-            simple_val = row.get(field, '').strip()
-            is_missing = (simple_val == '')
-            if is_missing and parent:
-                parent_val = parent.get(field, '').strip()
-                if parent_val:
+        if parent:
+            for field, parent_val in parent.items():
+                if get(field, '').strip() == '':
                     row[field] = parent_val
 
 
         # Now process the row using the (potentially updated) values.
-        product_name = row.get('name', '')
-        unit_per_pack_str = row.get('unit_per_pack', '')
-        pack_size = extract_pack_size(product_name, unit_per_pack_str)
+        pack_size = extract_pack_size(get('name', ''), get('unit_per_pack', ''))
 
         # Process and cast custom fields.
-        flavor = row.get('flavor', '').strip()
-        nicotine_level = row.get('nicotine_level')
-        volume = row.get('volume')
-        resistance = row.get('resistance', '').strip()
-        category = row.get('attribute_set_code', '').strip()
-        
-        try:
-            puff_count = int(float(row.get('puff_counts', 0)))
-        except ValueError:
-            puff_count = 0
+        flavor = get('flavor', '').strip()
+        nicotine_level = get('nicotine_level')
+        volume = get('volume')
+        resistance = get('resistance', '').strip()
+        category = get('attribute_set_code', '').strip()
+        brand = get('brand', '')
+        puff_count = _to_int(get('puff_counts', 0))
+        qty = _to_int(get('qty', 0))
 
         # Update row with casted values.
         row['flavor'] = flavor
@@ -405,28 +495,44 @@ def clean_and_aggregate_magento_csv(input_file, output_file, inventory_csv_file,
         row['volume'] = volume
         row['puff_counts'] = puff_count
         row['resistance'] = resistance
-        
-        try:
-            qty = int(float(row.get('qty', '0')))
-        except ValueError:
-            qty = 0
         row['original_qty'] = qty  # Store the original quantity
         row['pack_size'] = pack_size
 
         # Check if this is a inventory item
-        is_inventory_item = row['sku'] in inventory_sku_map
+        is_inventory_item = sku in inventory_sku_map
         
         # Only generate canonical name if there's enough attribute data
         canonical_name = ""
-        if should_generate_canonical_name(volume, nicotine_level, flavor, resistance):
-            canonical_name = generate_canonical_name(parent_sku, category, row.get('brand', ''), volume, nicotine_level, flavor, resistance)
+        attrs = clean_canonical_attributes(volume, nicotine_level, flavor, resistance)
+        if attrs:
+            canonical_name = generate_canonical_name(parent_sku, category, brand, attrs)
             row['canonical_name'] = canonical_name
             
             # Only group products with valid canonical names
             if canonical_name:
-                products_by_key.setdefault(canonical_name, []).append(row)
+                group_id = canonical_ids.get(canonical_name)
+                if group_id is None:
+                    group_id = len(product_groups)
+                    canonical_ids[canonical_name] = group_id
+                    product_groups.append({
+                        'rows': [],
+                        'pack_sizes': [],
+                        'in_inventory': [],
+                        'single_sku': '',
+                        'single_in_inventory': False
+                    })
+                group = product_groups[group_id]
+                group['rows'].append(row)
+                group['pack_sizes'].append(pack_size)
+                group['in_inventory'].append(is_inventory_item)
+                if pack_size == 1 and not group['single_in_inventory']:
+                    if is_inventory_item:
+                        group['single_sku'] = sku
+                        group['single_in_inventory'] = True
+                    elif not group['single_sku']:
+                        group['single_sku'] = sku
                 if is_inventory_item:
-                    processed_inventory_skus.add(row['sku'])
+                    processed_inventory_skus.add(sku)
                 continue
 
         # For products without a valid canonical name or not grouped
@@ -436,39 +542,7 @@ def clean_and_aggregate_magento_csv(input_file, output_file, inventory_csv_file,
         # Always keep inventory items
         if is_inventory_item:
             standalone_products.append(row)
-            processed_inventory_skus.add(row['sku'])
-
-    # Process the grouped products
-    grouped_products = []
-    for key, rows in products_by_key.items():
-        # the sku of the single pack of the product
-        single_product_sku = ''
-        for row in rows:
-            if int(row['pack_size']) == 1 and row['sku'] in inventory_sku_map:
-                single_product_sku = row['sku']
-                break
-        
-        # If no single pack in inventory found, try any single pack
-        if not single_product_sku:
-            for row in rows:
-                if int(row['pack_size']) == 1:
-                    single_product_sku = row['sku']
-                    break
-
-        # Process each row in the group
-        for row in rows:
-            # If multi-pack and we have a single pack reference
-            if int(row['pack_size']) > 1 and single_product_sku:
-                row['single_product_sku'] = single_product_sku
-            else:
-                row['single_product_sku'] = ''
-            
-            # Always keep items in inventory
-            if row['sku'] in inventory_sku_map:
-                grouped_products.append(row)
-            # Keep multi-packs that reference an inventory item
-            elif row['pack_size'] > 1 and single_product_sku and single_product_sku in inventory_sku_map:
-                grouped_products.append(row)
+            processed_inventory_skus.add(sku)
 
     # Add any inventory items that haven't been processed yet
     for sku, data in inventory_sku_map.items():
@@ -487,40 +561,85 @@ def clean_and_aggregate_magento_csv(input_file, output_file, inventory_csv_file,
                 'canonical_name': '',
                 'single_product_sku': '',
                 'original_qty': data['qty'],
-                'locations': ';'.join(f"{loc}:{qty}" for loc, qty in data['locations'].items())
+                'locations': data['locations_str']
             }
             # Fill in defaults for required columns
             for col in columns_to_keep:
                 if col not in row:
                     row[col] = ''
             standalone_products.append(row)
-    
-    # Combine all products for the final output
-    all_rows_to_write = grouped_products + standalone_products
-
-    # DEDUPLICATION STEP: Create a dictionary to track unique SKUs
-    unique_skus = {}
-    deduplicated_rows = []
-    for row in all_rows_to_write:
-        sku = row.get('sku', '').strip()
-        if sku and sku not in unique_skus:
-            unique_skus[sku] = True
-            deduplicated_rows.append(row)
-        else:
-            print(f"Dropping duplicate SKU: {sku}")
-
-    print(f"Removed {len(all_rows_to_write) - len(deduplicated_rows)} duplicate SKUs")
-    print(f"Final unique SKU count: {len(deduplicated_rows)}")
 
+    # The simple and parent rows are no longer needed once grouped.
+    simple_products.clear()
+    parent_products.clear()
 
     # Write the final CSV with original columns plus the extra derived columns.
-    with open(output_file, mode='w', encoding='utf-8', newline='') as outfile:
+    # Grouped products are written as each group is resolved, followed by the
+    # standalone products, so no combined list of output rows is built. The rows
+    # themselves stay in product_groups and standalone_products until written.
+    with open(output_file, mode='w', encoding='utf-8', newline='', buffering=_CSV_BUFFER_SIZE) as outfile:
         fieldnames = columns_to_keep + extra_columns
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in deduplicated_rows:
-            output_row = {col: row.get(col, '') for col in fieldnames}
-            writer.writerow(output_row)
+        writer = csv.writer(outfile)
+        writer.writerow(fieldnames)
+
+        # DEDUPLICATION STEP: Track unique SKUs as rows are written
+        unique_skus = set()
+        pending_rows = []
+        written_count = 0
+        # Dropped SKUs are reported together once writing is done
+        dropped_skus = []
+
+        def write_row(row):
+            nonlocal written_count
+            sku = row.get('sku', '').strip()
+            if sku and sku not in unique_skus:
+                unique_skus.add(sku)
+                pending_rows.append([row.get(col, '') for col in fieldnames])
+                if len(pending_rows) >= _WRITE_BATCH_SIZE:
+                    writer.writerows(pending_rows)
+                    pending_rows.clear()
+                written_count += 1
+            else:
+                dropped_skus.append(sku)
+
+        # Process the grouped products
+        for group in product_groups:
+            rows = group['rows']
+            # the sku of the single pack of the product
+            single_product_sku = group['single_sku']
+            single_in_inventory = group['single_in_inventory']
+
+            # Process each row in the group
+            for row, pack_size, in_inventory in zip(rows, group['pack_sizes'], group['in_inventory']):
+                # If multi-pack and we have a single pack reference
+                if pack_size > 1 and single_product_sku:
+                    row['single_product_sku'] = single_product_sku
+                else:
+                    row['single_product_sku'] = ''
+                
+                # Always keep items in inventory
+                if in_inventory:
+                    write_row(row)
+                # Keep multi-packs that reference an inventory item
+                elif pack_size > 1 and single_in_inventory:
+                    write_row(row)
+
+            # Release the group's rows as soon as they are written
+            rows.clear()
+        product_groups.clear()
+        canonical_ids.clear()
+
+        for row in standalone_products:
+            write_row(row)
+        standalone_products.clear()
+
+        writer.writerows(pending_rows)
+        pending_rows.clear()
+
+    if dropped_skus:
+        print('\n'.join(f"Dropping duplicate SKU: {sku}" for sku in dropped_skus))
+    print(f"Removed {len(dropped_skus)} duplicate SKUs")
+    print(f"Final unique SKU count: {written_count}")
 
 if __name__ == '__main__':
     magento_csv = 'product_magento_all.csv'                # Update with your CSV file path.
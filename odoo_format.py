@@ -4,10 +4,25 @@ import re
 
 # Input CSV from Magento
 input_filename = "magento_cleaned_aggregated.csv"
-df = pd.read_csv(input_filename)
+# Only parse the columns used below, and read the SKU and location columns as text
+# so pandas does not have to infer their types. Numeric-looking SKUs therefore stay
+# strings: leading zeros are kept in default_code, and single_product_sku compares
+# equal to sku when building the BoM.
+input_columns = [
+    "sku", "attribute_set_code", "name", "weight", "price", "qty", "brand", "cost",
+    "flavor", "nicotine_level", "puff_counts", "volume", "resistance", "pack_size",
+    "single_product_sku", "upc", "locations",
+]
+df = pd.read_csv(
+    input_filename,
+    usecols=input_columns,
+    dtype={"sku": str, "single_product_sku": str, "locations": str},
+)
 
-# Modify categ_id to include "All / " prefix
-df["categ_id"] = "All / " + df["attribute_set_code"].fillna("Default").astype(str)
+# Modify categ_id to include "All / " prefix, stored as a categorical so the prefix
+# is only added once per distinct attribute set
+attribute_sets = df["attribute_set_code"].fillna("Default").astype(str).astype("category")
+df["categ_id"] = attribute_sets.cat.rename_categories(lambda name: "All / " + name)
 
 # Extract all unique categories
 output_dir = "output"
@@ -49,38 +64,29 @@ if duplicates_found:
     df.drop_duplicates(subset=["sku"], keep="first", inplace=True)
     print(f"After removing duplicates: {len(df)} rows")
 
-# Convert numeric columns to integers, handling nulls and strings
-def safe_convert_to_int(value):
-    try:
-        if pd.isna(value) or value == '':
-            return 0
-        # First convert to float (to handle decimal strings) then to int
-        return int(float(value))
-    except (ValueError, TypeError):
-        return 0
-
-# Apply integer conversion to the specific columns
-df['puff_counts'] = df['puff_counts'].apply(safe_convert_to_int)
-df['volume'] = df['volume'].apply(safe_convert_to_int)
-df['nicotine_level'] = df['nicotine_level'].apply(safe_convert_to_int)
-
-odoo_df = pd.DataFrame({
-    "default_code": df["sku"],
-    "name": df["name"],
-    "categ_id": df["categ_id"],
-    "list_price": df["price"],
-    "standard_price": df["cost"],
-    "type": "goods", 
-    "barcode": df["upc"],
-    "weight": df["weight"],
-    "x_puff_count": df["puff_counts"].astype(int),
-    "x_flavor": df["flavor"],
-    "x_volume": df["volume"].astype(int),
-    "x_nicotine_level": df["nicotine_level"].astype(int),
-    "x_pack_size": df["pack_size"],
-    "x_brand": df["brand"],
-    "x_resistance": df["resistance"], 
-})
+# Convert numeric columns to integers, treating nulls and non-numeric strings as 0
+for column in ('puff_counts', 'volume', 'nicotine_level'):
+    df[column] = pd.to_numeric(df[column], errors='coerce').fillna(0).astype('int64')
+
+# Map the Magento columns onto the Odoo product import columns
+odoo_columns = {
+    "sku": "default_code",
+    "name": "name",
+    "categ_id": "categ_id",
+    "price": "list_price",
+    "cost": "standard_price",
+    "upc": "barcode",
+    "weight": "weight",
+    "puff_counts": "x_puff_count",
+    "flavor": "x_flavor",
+    "volume": "x_volume",
+    "nicotine_level": "x_nicotine_level",
+    "pack_size": "x_pack_size",
+    "brand": "x_brand",
+    "resistance": "x_resistance",
+}
+odoo_df = df[list(odoo_columns)].rename(columns=odoo_columns)
+odoo_df.insert(odoo_df.columns.get_loc("standard_price") + 1, "type", "goods")
 
 # Function to split and save DataFrame in chunks
 def split_and_save_csv(df, folder_name, base_filename, chunk_size=1999):
@@ -99,7 +105,7 @@ split_and_save_csv(odoo_df, "products", "odoo_import")
 # 1. Products with pack_size > 1 (multi-packs)
 # 2. Products that have a valid single_product_sku (not empty)
 # 3. Products whose single_product_sku exists in our valid components list
-valid_components = df["sku"].unique()
+valid_components = df["sku"]
 bom_df = df[
     (df['pack_size'] > 1) & 
     (df['single_product_sku'].notna()) & 
@@ -125,84 +131,38 @@ else:
     print("No valid multi-pack products with single product SKUs found for BoM creation")
 
 # Process location format (G-4-1) into hierarchical structure (WH / G / 4 / 1)
-def parse_location(location_str):
-    # Check if location matches the pattern like "G-4-1"
-    pattern = r'^([A-Za-z])-(\d+)-(\d+)$'
-    match = re.match(pattern, location_str.strip())
-    
-    if match:
-        row = match.group(1).upper()  # G (row of shelf)
-        column = match.group(2)       # 4 (column)
-        level = match.group(3)        # 1 (shelf level)
-        
-        # Return structured location path and components
-        return {
-            'path': f"WH/{row}/{column}/{level}",
-            'row': row,
-            'column': column,
-            'level': level
-        }
-    else:
-        # If location doesn't match expected format, place directly under WH
-        return {
-            'path': f"WH/{location_str.strip()}",
-            'row': None,
-            'column': None,
-            'level': None
-        }
+location_re = re.compile(r'^([A-Za-z])-(\d+)-(\d+)$')
 
-# Parse the locations string into separate rows for each location
-def expand_locations(row):
-    sku = row.get('sku', '')
-     # Skip products with BoM (multi-packs with single product relationships)
-    if sku in products_with_bom:
-        return []
-        
-    locations_str = row.get('locations', '')
-    if pd.isna(locations_str) or str(locations_str).strip() == '':
-        return []
-    
-    expanded_rows = []
-    for loc_qty in locations_str.split(';'):
-        if ':' not in loc_qty:
-            continue
-        location, qty = loc_qty.split(':')
-        parsed_location = parse_location(location)
-        expanded_rows.append({
-            'product': row['sku'],
-            'location': parsed_location['path'],
-            'inventoried_quantity': int(qty),
-            'original_location': location.strip()
-        })
-    return expanded_rows
-
-# Create expanded inventory rows with locations
-inventory_rows = []
-for _, row in df.iterrows():
-    location_rows = expand_locations(row)
-    inventory_rows.extend(location_rows)
-    
-# Convert to DataFrame
-location_inventory_df = pd.DataFrame(inventory_rows)
+# Exclude products with BoM (multi-packs with single product relationships) from inventory once
+inventory_df = df[~df['sku'].isin(bom_df['sku'])]
 
-# Filter out products with BoM relationships from the products_without_locations
-products_without_locations = df[
-    ((df['locations'].isna()) | (df['locations'] == '')) &
-    (~df['sku'].isin(products_with_bom))  # Exclude products with BoM
+# Parse the locations string into separate rows for each location
+stocked = inventory_df.loc[inventory_df['locations'].notna(), ['sku', 'locations']]
+location_pairs = stocked.assign(pair=stocked['locations'].astype(str).str.split(';')).explode('pair')
+location_pairs = location_pairs[location_pairs['pair'].str.contains(':', regex=False)]
+pair_parts = location_pairs['pair'].str.split(':')
+original_location = pair_parts.str[0].str.strip()
+
+# Locations like "G-4-1" become WH/G/4/1, anything else is placed directly under WH
+location_parts = original_location.str.extract(location_re)
+location_paths = (
+    'WH/' + location_parts[0].str.upper() + '/' + location_parts[1] + '/' + location_parts[2]
+).where(location_parts[0].notna(), 'WH/' + original_location)
+
+# Products without locations (products with BoM relationships are already excluded)
+products_without_locations = inventory_df[
+    (inventory_df['locations'].isna()) | (inventory_df['locations'] == '')
 ]
-
-
-if not products_without_locations.empty:
-    default_location_rows = pd.DataFrame({
-        'product': products_without_locations['sku'],
-        'location': 'WH/Stock',  # Default Odoo location
-        'inventoried_quantity': products_without_locations['qty'],
-        'original_location': 'Stock'
-    })
-    if len(location_inventory_df) > 0:
-        location_inventory_df = pd.concat([location_inventory_df, default_location_rows])
-    else:
-        location_inventory_df = default_location_rows
+default_count = len(products_without_locations)
+
+# Create expanded inventory rows with locations, followed by the products without
+# locations placed in the default Odoo location, in a single DataFrame build
+location_inventory_df = pd.DataFrame({
+    'product': location_pairs['sku'].tolist() + products_without_locations['sku'].tolist(),
+    'location': location_paths.tolist() + ['WH/Stock'] * default_count,
+    'inventoried_quantity': pair_parts.str[1].astype('int64').tolist() + products_without_locations['qty'].tolist(),
+    'original_location': original_location.tolist() + ['Stock'] * default_count
+})
 
 
 # Sort and reset index for inventory
@@ -221,79 +181,41 @@ else:
     print("No inventory data found.")
 
 # Process locations for hierarchical structure
-all_locations = {'WH': {'type': 'view', 'parent': None, 'level': 0}}
-
-# Process all locations to build the hierarchy
-if len(location_inventory_df) > 0:
-    for _, row in location_inventory_df.iterrows():
-        location_path = row['location']
-        
-        # Skip the default location which is already handled
-        if location_path == 'WH/Stock':
-            all_locations['WH/Stock'] = {'type': 'internal', 'parent': 'WH', 'level': 1}
-            continue
-            
-        # Split the path into components
-        parts = location_path.split('/')
-        
-        # Skip invalid paths
-        if len(parts) < 2:
-            continue
-            
-        # Process each level of the path to ensure all parent locations exist
-        for i in range(2, len(parts) + 1):
-            current_path = '/'.join(parts[:i])
-            parent_path = '/'.join(parts[:i-1])
-            
-            if current_path not in all_locations:
-                # Determine location type (internal for leaf nodes, view for parent nodes)
-                loc_type = 'internal'
-                all_locations[current_path] = {'type': loc_type, 'parent': parent_path, 'level': i-1}
-
-# Create location records for import
-location_records = []
-for path, details in all_locations.items():
-    # Special case for the root warehouse
-    if path == 'WH':
-        continue  # Skip WH as it already exists in Odoo
-        
-    name = path.split('/')[-1]  # Last component of the path is the location name
-    location_records.append({
-        'name': name,
-        'location_type': details['type'],
-        'parent_location': details['parent'],
-        'posx': 0,  # Default position values
-        'posy': 0,
-        'posz': 0,
-        'level': details['level']
-    })
+# Every location path contributes itself and all of its parents below WH (e.g. WH/G,
+# WH/G/4, WH/G/4/1); drop_duplicates keeps first-seen order so parents come first
+hierarchy_paths = pd.Series([
+    '/'.join(parts[:i])
+    for parts in (path.split('/') for path in location_inventory_df['location'].unique())
+    for i in range(2, len(parts) + 1)
+], dtype=object).drop_duplicates()
+parent_and_name = hierarchy_paths.str.rsplit('/', n=1)
+
+# Create location records for import (WH is skipped as it already exists in Odoo)
+location_records = pd.DataFrame({
+    'name': parent_and_name.str[-1],  # Last component of the path is the location name
+    'location_type': 'internal',
+    'parent_location': parent_and_name.str[0],
+    'posx': 0,  # Default position values
+    'posy': 0,
+    'posz': 0,
+    'level': hierarchy_paths.str.count('/')
+})
 
 # Sort locations by level to ensure parent locations are created first
-location_records.sort(key=lambda x: x['level'])
+location_records = location_records.sort_values('level', kind='stable')
 
 
 # Create DataFrame for locations import and split by hierarchy level
-if location_records:
-    # Group locations by their hierarchy level
-    locations_by_level = {}
-    for record in location_records:
-        level = record['level']
-        if level not in locations_by_level:
-            locations_by_level[level] = []
-        locations_by_level[level].append(record)
-    
+if not location_records.empty:
     # Create a directory for locations
     locations_dir = os.path.join(output_dir, "locations")
     os.makedirs(locations_dir, exist_ok=True)
     
     # Create separate CSV files for each level
     total_locations = 0
-    for level, records in sorted(locations_by_level.items()):
-        # Create DataFrame for this level
-        level_df = pd.DataFrame(records)
-        
+    for level, records in location_records.groupby('level'):
         # Reorder columns for clarity and remove the level column which is only for sorting
-        level_df = level_df[['name', 'location_type', 'parent_location', 'posx', 'posy', 'posz']]
+        level_df = records[['name', 'location_type', 'parent_location', 'posx', 'posy', 'posz']]
         
         # Save this level to its own CSV file
         level_filename = os.path.join(locations_dir, f"odoo_locations_level_{level}.csv")
@@ -302,9 +224,8 @@ if location_records:
         total_locations += len(records)
         print(f"Level {level} locations saved to: {level_filename} ({len(records)} locations)")
     
-    # Also create a combined file for reference
-    all_locations_df = pd.DataFrame(location_records)
-    all_locations_df = all_locations_df[['name', 'location_type', 'parent_location', 'posx', 'posy', 'posz', 'level']]
+    # Also create a combined file for reference from the same level-sorted records
+    all_locations_df = location_records[['name', 'location_type', 'parent_location', 'posx', 'posy', 'posz', 'level']]
     combined_filename = os.path.join(locations_dir, "odoo_locations_all.csv")
     all_locations_df.to_csv(combined_filename, index=False)
     
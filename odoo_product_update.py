@@ -9,31 +9,27 @@ updates_filename = "odoo_import.csv"
 updates_df = pd.read_csv(updates_filename)
 
 # Convert barcode column to string and remove decimals
-updates_df['barcode'] = updates_df['barcode'].fillna('').astype(str).apply(lambda x: x.split('.')[0] if '.' in x else x)
+updates_df['barcode'] = updates_df['barcode'].fillna('').astype(str).str.split('.', n=1).str[0]
 
 # Create a mapping from SKU to barcode, excluding empty barcodes
-sku_to_barcode = {
-    sku: barcode 
-    for sku, barcode in zip(updates_df['default_code'], updates_df['barcode']) 
-    if barcode and barcode != ''
-}
+# (the last barcode listed for a SKU wins)
+sku_to_barcode = (
+    updates_df.loc[updates_df['barcode'] != '', ['default_code', 'barcode']]
+    .drop_duplicates(subset=['default_code'], keep='last')
+    .set_index('default_code')['barcode']
+)
 
 # Create the update DataFrame
-update_rows = []
-for _, row in odoo_df.iterrows():
-    sku = row['default_code']
-    if sku in sku_to_barcode and pd.notna(sku_to_barcode[sku]):
-        update_rows.append({
-            'id': row['id'],
-            'barcode': sku_to_barcode[sku]
-        })
+updates_output = (
+    odoo_df.assign(barcode=odoo_df['default_code'].map(sku_to_barcode))
+    .dropna(subset=['barcode'])[['id', 'barcode']]
+)
 
-# Convert to DataFrame and save
-if update_rows:
-    updates_output = pd.DataFrame(update_rows)
+# Save the updates
+if not updates_output.empty:
     output_filename = "odoo_product_updates.csv"
     updates_output.to_csv(output_filename, index=False)
     print(f"Created update file: {output_filename}")
-    print(f"Number of products to update: {len(update_rows)}")
+    print(f"Number of products to update: {len(updates_output)}")
 else:
     print("No updates found")
\ No newline at end of file